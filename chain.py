@@ -1,13 +1,17 @@
 # coding: utf8
 import os
+import json
 import logging
 import sys
 import re
+import signal
 
 from collections import defaultdict
+from hashlib import md5
 from statflow.mr.localstreamer import LocalStreamer
 from subprocess import PIPE, Popen
 from lazy import lazy
+from time import time
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +69,9 @@ class ChainPlan(object):
             if node.dst.startswith(self.tmp_prefix):
                 continue
             result.add(node.dst)
+        for node in self.nodes:
+            if node.node_type == 'SplitByDate':
+                result.update(node.dst.values())
         return list(result)
 
 
@@ -116,6 +123,16 @@ class Chain(object):
                     file_src = os.path.join(path_prefix, file_src)
                 files.append(file_src)
             node_list.append(ChainNode(src_list, 'mr', cls.__name__ + step.__name__, dst=dst, step=step, files=files, original_step_number=step_num))
+            split_dst = getattr(step, 'split_dst', None)
+            if split_dst is not None:
+                # records tagged with `sample_date` are split into a dst per date in a single pass, dst of this node
+                # is a dict date -> path and only LocalChainRunner runs it, so chains with split steps are local only
+                split_dst_list = {}
+                for split_date in step.split_dates(context):
+                    split_dst_list[split_date] = cls._apply_template(split_dst, dict(template_params, date=split_date))
+                    if not split_dst_list[split_date].startswith('/'):
+                        split_dst_list[split_date] = os.path.join(path_prefix, split_dst_list[split_date])
+                node_list.append(ChainNode([dst], 'SplitByDate', cls.__name__ + step.__name__ + 'SplitByDate', dst=split_dst_list, step=step, files=[], original_step_number=step_num))
             template_params['prev'] = dst
         return node_list
 
@@ -155,8 +172,9 @@ class Chain(object):
 class LocalChainRunner(object):
     # TODO move it in a separate file
 
-    def __init__(self, chain_plan):
+    def __init__(self, chain_plan, workers=1):
         self.chain_plan = chain_plan
+        self.workers = workers
 
     def _filter_sources(self, sources, path_prefix):
         node_sources = [os.path.join(path_prefix, src.strip('/')) for src in sources]
@@ -173,6 +191,48 @@ class LocalChainRunner(object):
                     node_sources_files.append(full_file_path)
         return node_sources_files
 
+    def _fork_task(self, target, *args):
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        code = 0
+        try:
+            target(*args)
+        except BaseException:
+            logger.exception('Task failed')
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _run_forked(self, tasks):
+        running = set()
+        failed = 0
+        try:
+            for target, args in tasks:
+                if len(running) >= self.workers:
+                    pid, status = os.wait()
+                    running.discard(pid)
+                    failed += status != 0
+                running.add(self._fork_task(target, *args))
+        except BaseException:
+            for pid in running:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+                os.waitpid(pid, 0)
+            raise
+        for pid in running:
+            _, status = os.waitpid(pid, 0)
+            failed += status != 0
+        if failed:
+            raise Exception('%s of %s tasks failed' % (failed, len(tasks)))
+
+    def _run_map_task(self, step, source, dst, cls_args):
+        # the same variable as hadoop streaming sets for steps that depend on the input file
+        os.environ['mapreduce_map_input_file'] = source
+        LocalStreamer.run(step, 'map', [source], dst, cls_args)
+
     def run_mr_step(self, node, path_prefix):
         from shutil import copyfile, rmtree
         from statflow.config import config
@@ -190,6 +250,9 @@ class LocalChainRunner(object):
         src = sources if not node.step.has_map else [postmapdata]
         dst = os.path.join(path_prefix, node.dst.lstrip('/')) if not node.step.has_reduce else postmapdata
         cls_args = {'date': self.chain_plan.context['execution_date'].date().isoformat()}
+        params = self.chain_plan.context.get('params') or {}
+        if hasattr(node.step, 'date_from') and 'date_from' in params:
+            cls_args['date_from'] = params['date_from']
 
         file_src = [f.split('#')[0] for f in node.files]
         file_names = [f.split('#')[1] for f in node.files]
@@ -204,30 +267,113 @@ class LocalChainRunner(object):
                 name = name if name != '' else os.path.basename(f)
                 copyfile(f, name)
 
-            if node.step.has_map:
+            started = time()
+            per_source = self.workers > 1 and len(sources) > 1 or getattr(node.step, 'needs_input_file', False)
+            if node.step.has_map and node.step.has_reduce and per_source:
+                # every source is a separate map task, in parallel with several workers, outputs are merged by sort below
+                if os.path.isdir(postmapdata):
+                    rmtree(postmapdata)
+                elif os.path.exists(postmapdata):
+                    os.remove(postmapdata)
+                os.makedirs(postmapdata)
+                tasks = [(self._run_map_task, (node.step, source, os.path.join(postmapdata, 'part-%05d' % num), cls_args))
+                         for num, source in enumerate(sources)]
+                self._run_forked(tasks)
+                src = [os.path.join(postmapdata, '*')]
+            elif node.step.has_map:
+                if os.path.isdir(postmapdata):
+                    rmtree(postmapdata)
                 LocalStreamer.run(node.step, 'map', sources, dst, cls_args)
+            if node.step.has_map:
+                logger.info('Map of %s took %.1fs', node.step.__name__, time() - started)
             if node.step.has_reduce:
+                started = time()
                 f = open(os.path.join(path_prefix, 'sorted_reduce_source'), 'w')
                 p = Popen('cat %s' % ' '.join(src), shell=True, stdout=PIPE)
                 Popen('sort', shell=True, stdin=p.stdout, stdout=f, env={'LC_ALL': 'C'}).communicate()
                 p.stdout.close()
                 f.close()
+                sorted_at = time()
                 LocalStreamer.run(node.step, 'reduce', [f.name], os.path.join(path_prefix, node.dst.lstrip('/')), cls_args)
+                logger.info('Reduce of %s took %.1fs (sort %.1fs)', node.step.__name__, time() - started, sorted_at - started)
         finally:
             rmtree(temp_path, ignore_errors=True)
 
+    def run_split_by_date(self, node, path_prefix):
+        outputs = {}
+        for split_date, dst in node.dst.items():
+            dst = os.path.join(path_prefix, dst.lstrip('/'))
+            if not os.path.exists(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            outputs[split_date] = open(dst, 'w')
+        try:
+            for src in self._filter_sources(node.src, path_prefix):
+                with open(src) as f:
+                    for line in f:
+                        key, value = line.rstrip('\n').split('\t', 1)
+                        rec = json.loads(value)
+                        outputs[rec.pop('sample_date')].write('%s\t%s\n' % (key, json.dumps(rec)))
+        finally:
+            for output in outputs.values():
+                output.close()
+
     def run_garbage_collection(self, node):
         for src in node.src:
             os.remove(src)
 
-    def run_chain(self, path_prefix, start_step=0, finish_step=sys.maxint):
+    def _fingerprint(self, paths, path_prefix):
+        digest = md5()
+        for f in sorted(self._filter_sources(paths, path_prefix)):
+            stat = os.stat(f)
+            digest.update('%s:%s:%s\n' % (f, stat.st_size, stat.st_mtime))
+        return digest.hexdigest()
+
+    def _manifest_path(self, node, path_prefix):
+        manifests = os.path.join(path_prefix, self.chain_plan.tmp_prefix.strip('/'), 'manifests')
+        return os.path.join(manifests, '%s-%s.manifest' % (node.original_step_number, node.name))
+
+    def _node_manifest(self, node, path_prefix):
+        return {
+            'node': node.name,
+            'inputs': self._fingerprint(node.src + [f.split('#')[0] for f in node.files], path_prefix),
+            'output': self._fingerprint([node.dst], path_prefix),
+        }
+
+    def _is_node_completed(self, node, path_prefix):
+        manifest_path = self._manifest_path(node, path_prefix)
+        if not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        return manifest == self._node_manifest(node, path_prefix)
+
+    def run_chain(self, path_prefix, start_step=0, finish_step=sys.maxint, resume=False):
+        """
+        With `resume` every finished mr node gets a manifest under the chain tmp dir with fingerprints
+        (names, sizes and mtimes) of its inputs and output, and nodes whose manifest still matches are skipped,
+        so a rerun redoes only missing or changed pieces.
+        """
         for node in self.chain_plan.nodes:
             if node.original_step_number is not None and not finish_step >= node.original_step_number >= start_step:
                 continue
             if node.node_type == 'DeleteTempTable':
                 logger.info('Start garbage collection %s', node.src)
                 # self.run_cleaner(node)
+            elif node.node_type == 'SplitByDate':
+                logger.info('Start split by date %s', node.src)
+                self.run_split_by_date(node, path_prefix)
             elif node.node_type == 'mr':
+                if resume and self._is_node_completed(node, path_prefix):
+                    logger.info('Skip completed mr step %s', node.step.__name__)
+                    continue
+                manifest_path = self._manifest_path(node, path_prefix)
+                if resume and os.path.exists(manifest_path):
+                    os.remove(manifest_path)
                 logger.info('Start mr step %s', node.step.__name__)
                 self.run_mr_step(node, path_prefix)
+                if resume:
+                    if not os.path.exists(os.path.dirname(manifest_path)):
+                        os.makedirs(os.path.dirname(manifest_path))
+                    with open(manifest_path, 'w') as f:
+                        json.dump(self._node_manifest(node, path_prefix), f)
                 logger.info('Finish mr step. dst %s', os.path.join(path_prefix, node.dst.lstrip('/')))
@@ -1,4 +1,5 @@
 # coding: utf8
+import os
 import re
 
 from statflow.mr import Step, Chain
@@ -48,6 +49,66 @@ services = {
 }
 
 
+def get_backfill_dates(date_from, date_to):
+    return [date_from + relativedelta(days=days) for days in range((date_to - date_from).days + 1)]
+
+
+def get_context_backfill_dates(context):
+    date_from = datetime_from_iso(context['params']['date_from']).date()
+    return [date.isoformat() for date in get_backfill_dates(date_from, context['execution_date'].date())]
+
+
+def get_backfill_contracts_src(context):
+    return [re.sub(r'\{\{\s*date\s*\}\}', date, PrepareRuCenterContractsNew.dst) for date in get_context_backfill_dates(context)]
+
+
+def get_input_date():
+    # hadoop streaming exposes the current input file, LocalChainRunner sets it for every map task
+    path = os.environ.get('mapreduce_map_input_file') or os.environ.get('map_input_file') or ''
+    dates = re.findall(r'\d{4}-\d{2}-\d{2}', path)
+    if not dates:
+        raise Exception('Can not get date of input file `%s`' % path)
+    return dates[-1]
+
+
+class PartnerContracts(Step):
+    """
+    Collects ids of PARTNER contracts so FirstStep can drop their services before the shuffle.
+    """
+
+    src = [
+        PrepareRuCenterContractsNew.dst
+    ]
+
+    dst = '{{tmp}}/partner-contracts'
+
+    def map(self, key, rec):
+        if rec['__type__'] == 'prepared_contracts' and rec['contract_type'] == 'PARTNER':
+            yield rec['contract'], {'contract': rec['contract']}
+
+    def reduce(self, key, records):
+        yield key, records.next()
+
+
+class BackfillPartnerContracts(PartnerContracts):
+    """
+    Collects ids of contracts that are PARTNER in every contracts snapshot of the backfill range they appear in.
+    """
+
+    @classmethod
+    def context_src(cls, context):
+        return get_backfill_contracts_src(context)
+
+    def map(self, key, rec):
+        if rec['__type__'] == 'prepared_contracts':
+            yield rec['contract'], {'contract': rec['contract'], 'contract_type': rec['contract_type']}
+
+    def reduce(self, key, records):
+        records = list(records)
+        if all(rec['contract_type'] == 'PARTNER' for rec in records):
+            yield key, {'contract': records[0]['contract']}
+
+
 class FirstStep(Step):
 
     days_interval = 366
@@ -60,7 +121,10 @@ class FirstStep(Step):
 
     dst = 'log/recommender-training-set/{{date}}'
 
-    files = 'log/rucenter-table-services-type-name/{{date}}/-#services.json'
+    files = [
+        'log/rucenter-table-services-type-name/{{date}}/-#services.json',
+        '{{tmp}}/partner-contracts#partner_contracts'
+    ]
 
     def get_age(self, birth_date, to_date):
         return to_date.year - birth_date.year - ((to_date.month, to_date.day) < (birth_date.month, birth_date.day))
@@ -91,8 +155,21 @@ class FirstStep(Step):
         else:
             return '10_and_more_len_domains'
 
+    def load_partner_contracts(self, path):
+        paths = [path]
+        if os.path.isdir(path):
+            paths = [os.path.join(path, f) for f in os.listdir(path) if not f.startswith(('.', '_'))]
+        partner_contracts = set()
+        for file_path in paths:
+            with open(file_path, 'r') as f:
+                for line in f:
+                    rec = loads(line.rstrip('\n').split('\t')[-1])
+                    partner_contracts.add(unicode(rec['contract']))
+        return frozenset(partner_contracts)
+
     def premap(self):
         self.pattern_zipcode = re.compile('(\D|^)(\d{6})(\D|$)')
+        self.partner_contracts = self.load_partner_contracts('partner_contracts')
 
     def map(self, key, rec):
         if rec['__type__'] == 'prepared_contracts':
@@ -113,6 +190,8 @@ class FirstStep(Step):
         elif rec['__type__'] == 'rucenter-unified-services-snapshot':
             if not rec.get('serving_now') and not rec.get('is_payed'):
                 return
+            if unicode(rec['contract_name']) in self.partner_contracts:
+                return
             result = {
                 'cost_rur': rec.get('cost_rur'),
                 'pay_date': rec.get('pay_date'),
@@ -250,13 +329,76 @@ class FirstStep(Step):
         if client_info['contract_type'] == 'PARTNER':
             return
         records = [[datetime_from_iso(date) if date else date, rec] for order_flag, date, rec in records]
-        result = self.get_vector_of_features(self.date, records, client_info, 'untagged')
+        for context_date in self.context_dates():
+            for result in self.get_samples(context_date, records, client_info):
+                yield key, result
+
+    def context_dates(self):
+        return [self.date]
+
+    def get_samples(self, context_date, records, client_info):
+        result = self.get_vector_of_features(context_date, records, client_info, 'untagged')
         if result:
-            yield key, result
-        for result in self.get_negative_sample(self.date, records, client_info):
-            yield key, result
-        for result in self.get_positive_sample(self.date, records, client_info):
-            yield key, result
+            yield result
+        for result in self.get_negative_sample(context_date, records, client_info):
+            yield result
+        for result in self.get_positive_sample(context_date, records, client_info):
+            yield result
+
+
+class BackfillFirstStep(FirstStep):
+    """
+    FirstStep for every context date from `date_from` param up to the execution date in one shuffle.
+    Contracts are read from the snapshot of every date and every context date gets client info of its own snapshot.
+    Every sample is tagged with `sample_date` and the chain splits them into the per-date destinations in one pass.
+    Services come from the same snapshot as in FirstStep, the `days_interval` window is applied per context date.
+    """
+
+    date_from = None
+
+    needs_input_file = True
+
+    dst = '{{tmp}}/recommender-training-set'
+
+    split_dst = 'log/recommender-training-set/{{date}}'
+
+    @classmethod
+    def context_src(cls, context):
+        return get_backfill_contracts_src(context) + ['snapshot/rucenter-services']
+
+    @classmethod
+    def split_dates(cls, context):
+        return get_context_backfill_dates(context)
+
+    def map(self, key, rec):
+        for key, value in super(BackfillFirstStep, self).map(key, rec):
+            if value[0] == 'a':
+                value = ['a', get_input_date(), value[1]]
+            yield key, value
+
+    def reduce(self, key, records):
+        client_infos = {}
+        services = []
+        for record in records:
+            if record[0] == 'a':
+                client_infos[record[1]] = record[2]
+            else:
+                order_flag, date, rec = record
+                services.append([datetime_from_iso(date) if date else date, rec])
+        for context_date in self.context_dates():
+            client_info = client_infos.get(context_date.date().isoformat())
+            if client_info is None or client_info['contract_type'] == 'PARTNER':
+                continue
+            for result in self.get_samples(context_date, services, client_info):
+                yield key, result
+
+    def context_dates(self):
+        return get_backfill_dates(datetime_from_iso(self.date_from), self.date)
+
+    def get_samples(self, context_date, records, client_info):
+        for result in super(BackfillFirstStep, self).get_samples(context_date, records, client_info):
+            result['sample_date'] = context_date.date().isoformat()
+            yield result
 
 
 class FilterClasses(Step):
@@ -302,4 +444,13 @@ class GetRealServices(Step):
 
 class ExtractFeatures(Chain):
 
-    steps = [FirstStep, FilterClasses, GetRealServices]
+    steps = [PartnerContracts, FirstStep, FilterClasses, GetRealServices]
+
+
+class ExtractFeaturesBackfill(Chain):
+    """
+    Builds recommender-training-set for every date from `date_from` param up to the execution date.
+    Local only: the per-date split is a SplitByDate node, which is run by LocalChainRunner.
+    """
+
+    steps = [BackfillPartnerContracts, BackfillFirstStep]
@@ -1,5 +1,7 @@
 # coding: utf8
+import json
 import logging
+import sys
 
 from airflow.operators import BaseOperator
 from statflow.autowiring import WiredOperator
@@ -9,7 +11,10 @@ from statflow.config import config
 from statflow.oracle import OracleClient
 from sqlalchemy import create_engine
 from statflow.common import HiveMappingMixin
+from threading import Event, Thread
+from Queue import Queue, Empty, Full
 from time import time
+from zlib import crc32
 
 logger = logging.getLogger(__name__)
 
@@ -57,16 +62,20 @@ class ProxyDBObject():
 
 class ImportTableOperator(BaseOperator, WiredOperator):
 
-    def __init__(self, table, id_column, columns, **kwargs):
+    def __init__(self, table, id_column, columns, derived_columns=None, **kwargs):
         self.table = table
         self.columns = columns
         self.id_column = id_column
+        self.derived_columns = derived_columns or []
         super(ImportTableOperator, self).__init__(**kwargs)
 
     brand = None
     connection_config_path = None
     db_name = None
     tables = []
+    # rows per batch handed from the db fetcher thread to the hdfs writer and max batches waiting in the queue
+    fetch_batch_size = 5000
+    fetch_queue_size = 20
 
     def wired_dst(self, context):
         dst = ['log/%s-table-%s/%s' % (self.brand, self.table.replace('_', '-'), context['execution_date'].date().isoformat())]
@@ -77,16 +86,60 @@ class ImportTableOperator(BaseOperator, WiredOperator):
     @classmethod
     def wired_instances(cls, dag):
         operators = []
-        for table, id_column, columns in cls.tables:
-            operators.append(cls(table, id_column, columns, task_id='Import' + cls.brand.title() + table.title().replace('_', ''), dag=dag, pool='import_' + cls.brand))
+        for spec in cls.tables:
+            table, id_column, columns = spec[:3]
+            derived_columns = spec[3] if len(spec) > 3 else None
+            operators.append(cls(table, id_column, columns, derived_columns, task_id='Import' + cls.brand.title() + table.title().replace('_', ''), dag=dag, pool='import_' + cls.brand))
         return operators
 
-    def _get_data(self, context, table_name, columns, id_column=None, from_id=None, to_id=None):
-        columns = ','.join(columns)
+    def _get_derived_joins(self, context, derived_columns, id_column=None, from_id=None, to_id=None):
+        """
+        Every derived column is a dict with `name`, `table`, `key` and an optional `on` column of the imported
+        table (`id_column` by default) and numeric `default` value. With `expression` it is an aggregate over `table`
+        grouped by `key`, with `column` it is a plain lookup of that column of the row of `table` matching `key`.
+        Returns the select expressions and the joins that compute them in one set-based query.
+        """
+        columns = []
+        joins = []
+        for num, derived in enumerate(derived_columns):
+            alias = 'd%s' % num
+            on = derived.get('on', id_column)
+            if on is None:
+                raise RuntimeError("Derived column %s needs `on` column" % derived['name'])
+            table_name = context['db'].get_full_table_name(derived['table'])
+            if 'expression' in derived:
+                condition = ''
+                if on == id_column and from_id is not None:
+                    condition = """WHERE {} >= {} AND {} < {}""".format(derived['key'], from_id, derived['key'], to_id)
+                subquery = """SELECT {} derived_key, {} derived_value FROM {} {} GROUP BY {}""".format(
+                    derived['key'], derived['expression'], table_name, condition, derived['key'])
+                joins.append("""LEFT JOIN ({}) {} ON {}.derived_key = t.{}""".format(subquery, alias, alias, on))
+                value = '{}.derived_value'.format(alias)
+            elif 'column' in derived:
+                joins.append("""LEFT JOIN {} {} ON {}.{} = t.{}""".format(table_name, alias, alias, derived['key'], on))
+                value = '{}.{}'.format(alias, derived['column'])
+            else:
+                raise RuntimeError("Derived column %s needs `expression` or `column`" % derived['name'])
+            if derived.get('default') is not None:
+                if isinstance(derived['default'], bool) or not isinstance(derived['default'], (int, long, float)):
+                    raise RuntimeError("Default of derived column %s should be a number" % derived['name'])
+                value = 'COALESCE({}, {!r})'.format(value, derived['default'])
+            columns.append('{} as {}'.format(value, derived['name']))
+        return columns, joins
+
+    def _get_query(self, context, table_name, columns, id_column=None, from_id=None, to_id=None, derived_columns=None, count=False):
+        derived_columns, joins = self._get_derived_joins(context, derived_columns or [], id_column, from_id, to_id)
+        if joins:
+            # unqualified * is ambiguous with joined tables and rejected by oracle
+            columns = ['t.*' if column == '*' else column for column in columns]
+        columns = ','.join(columns + derived_columns) if not count else 'count(*) "count"'
         condition = ''
         if id_column is not None:
-            condition = """WHERE {} >= {} AND {} < {}""".format(id_column, from_id, id_column, to_id)
-        query = """SELECT {} FROM {} t {}""".format(columns, table_name, condition)
+            condition = """WHERE t.{} >= {} AND t.{} < {}""".format(id_column, from_id, id_column, to_id)
+        return """SELECT {} FROM {} t {} {}""".format(columns, table_name, ' '.join(joins), condition)
+
+    def _get_data(self, context, table_name, columns, id_column=None, from_id=None, to_id=None, derived_columns=None):
+        query = self._get_query(context, table_name, columns, id_column, from_id, to_id, derived_columns)
         logger.info("Start fetching data from table %s", table_name)
         result = context['db'].execute_query(query)
         rec = {
@@ -100,6 +153,72 @@ class ImportTableOperator(BaseOperator, WiredOperator):
             row.update(rec)
             yield row
 
+    def _pipeline_data(self, data, table_name):
+        """
+        Drains `data` in a separate thread so the db fetch overlaps with the hdfs write.
+        Logs how long each side waited for the other to show which one is the bottleneck.
+        """
+        queue = Queue(maxsize=self.fetch_queue_size)
+        stop = Event()
+        state = {'error': None, 'fetcher_wait': 0.0, 'writer_wait': 0.0, 'rows': 0}
+
+        def put(item):
+            started = time()
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=1)
+                    break
+                except Full:
+                    continue
+            state['fetcher_wait'] += time() - started
+
+        def fetch():
+            try:
+                batch = []
+                for row in data:
+                    if stop.is_set():
+                        return
+                    batch.append(row)
+                    if len(batch) >= self.fetch_batch_size:
+                        put(batch)
+                        batch = []
+                if batch:
+                    put(batch)
+            except Exception:
+                state['error'] = sys.exc_info()
+            finally:
+                put(None)
+
+        fetcher = Thread(target=fetch, name='fetcher-' + table_name)
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            while True:
+                started = time()
+                while True:
+                    try:
+                        batch = queue.get(timeout=1)
+                        break
+                    except Empty:
+                        if not fetcher.is_alive():
+                            raise RuntimeError("Fetcher for table %s died" % table_name)
+                state['writer_wait'] += time() - started
+                if batch is None:
+                    break
+                state['rows'] += len(batch)
+                for row in batch:
+                    yield row
+            if state['error'] is not None:
+                error_type, error, traceback = state['error']
+                raise error_type, error, traceback
+        finally:
+            stop.set()
+            fetcher.join()
+            logger.info(
+                "Table %s: %s rows, fetcher waited for writer %.1fs, writer waited for fetcher %.1fs",
+                table_name, state['rows'], state['fetcher_wait'], state['writer_wait']
+            )
+
     def _get_min_max_id(self, context, table_name, id_column):
         logger.info("Get min id and max id from %s", table_name)
         minmax_query = """SELECT min({}) "min", max({}) "max" FROM {}""".format(id_column, id_column, table_name)
@@ -108,22 +227,89 @@ class ImportTableOperator(BaseOperator, WiredOperator):
             return row['min'], row['max']
         raise RuntimeError("There is no id")
 
-    def import_table(self, context, table_name, dst, columns, id_column=None, from_id=None, to_id=None):
+    def _count_data(self, data, stats):
+        for row in data:
+            stats['rows'] += 1
+            yield row
+
+    def _get_slice_count(self, context, table_name, columns, id_column, from_id, to_id, derived_columns=None):
+        query = self._get_query(context, table_name, columns, id_column, from_id, to_id, derived_columns, count=True)
+        for row in context['db'].execute_query(query):
+            return row['count']
+
+    def _read_slice(self, hadoop, path):
+        """
+        Reads a written slice back and returns its row count and crc32 checksum. `__ts__` differs between
+        fetches and is left out, so the checksum depends only on the imported rows.
+        """
+        stats = {'rows': 0, 'checksum': 0}
+        for row in hadoop.get_data(path):
+            row.pop('__ts__', None)
+            stats['rows'] += 1
+            stats['checksum'] = crc32(json.dumps(row, sort_keys=True), stats['checksum'])
+        stats['checksum'] &= 0xffffffff
+        return stats
+
+    def import_table(self, context, table_name, dst, columns, id_column=None, from_id=None, to_id=None, derived_columns=None):
+        """
+        Sliced imports keep a manifest next to `dst` with a marker per completed slice named after the row count
+        and checksum of the slice as read back from hdfs. A retry skips a slice only if the file still matches
+        its marker and the row count of its id range in the db is unchanged, so missing, corrupt or partially
+        written slices are imported again. The manifest is removed on success.
+        """
         hadoop = context['hadoop']
-        if hadoop.exists(dst):
-            hadoop.rm(dst, recursive=True)
-        hadoop.mkdir(dst)
-        if id_column:
-            while from_id <= to_id:
-                offset_id = from_id + 400000
-                data = self._get_data(context, table_name, columns, id_column, from_id, offset_id)
-                logger.info("Put data from table %s to hdfs from %s to %s", table_name, from_id, offset_id)
-                hadoop.put_data(data, dst + '/' + str(from_id))
-                from_id = offset_id
-        else:
-            data = self._get_data(context, table_name, columns)
+        if not id_column:
+            if hadoop.exists(dst):
+                hadoop.rm(dst, recursive=True)
+            hadoop.mkdir(dst)
+            data = self._get_data(context, table_name, columns, derived_columns=derived_columns)
             logger.info("Put data from table %s to hdfs", table_name)
-            hadoop.put_data(data, dst)
+            hadoop.put_data(self._pipeline_data(data, table_name), dst)
+            return
+
+        manifest = dst + '.manifest'
+        # slices are aligned to min id, progress made with another min id can not be reused
+        base = manifest + '/base-' + str(from_id)
+        if not hadoop.exists(base):
+            for path in [dst, manifest]:
+                if hadoop.exists(path):
+                    hadoop.rm(path, recursive=True)
+            hadoop.mkdir(dst)
+            hadoop.mkdir(manifest)
+            hadoop.put_data([{'min_id': from_id}], base)
+        while from_id <= to_id:
+            offset_id = from_id + 400000
+            slice_dst = dst + '/' + str(from_id)
+            slice_manifest = manifest + '/' + str(from_id)
+            if hadoop.exists(slice_dst):
+                written = self._read_slice(hadoop, slice_dst)
+                marker = '%s/%s-%s' % (slice_manifest, written['rows'], written['checksum'])
+                if hadoop.exists(marker) and \
+                        written['rows'] == self._get_slice_count(context, table_name, columns, id_column, from_id, offset_id, derived_columns):
+                    logger.info("Skip imported slice of table %s from %s to %s", table_name, from_id, offset_id)
+                    from_id = offset_id
+                    continue
+                hadoop.rm(slice_dst, recursive=True)
+            if hadoop.exists(slice_manifest):
+                hadoop.rm(slice_manifest, recursive=True)
+            data = self._get_data(context, table_name, columns, id_column, from_id, offset_id, derived_columns)
+            logger.info("Put data from table %s to hdfs from %s to %s", table_name, from_id, offset_id)
+            stats = {'rows': 0}
+            hadoop.put_data(self._count_data(self._pipeline_data(data, table_name), stats), slice_dst)
+            written = self._read_slice(hadoop, slice_dst)
+            if written['rows'] != stats['rows']:
+                raise RuntimeError("Slice %s of table %s has %s rows instead of %s" % (slice_dst, table_name, written['rows'], stats['rows']))
+            # a slice that was cut by max id of this attempt may get new rows later, it is never marked as completed
+            if offset_id <= to_id:
+                hadoop.put_data([{
+                    'from_id': from_id,
+                    'to_id': offset_id,
+                    'max_id': to_id,
+                    'rows': written['rows'],
+                    'checksum': written['checksum'],
+                }], '%s/%s-%s' % (slice_manifest, written['rows'], written['checksum']))
+            from_id = offset_id
+        hadoop.rm(manifest, recursive=True)
 
     @context_hadoop
     def execute(self, context):
@@ -137,7 +323,7 @@ class ImportTableOperator(BaseOperator, WiredOperator):
         if self.id_column is not None:
             from_id, to_id = self._get_min_max_id(context, table_name, self.id_column)
         dst = 'log/%s-table-%s/%s' % (self.brand, self.table.replace('_', '-'), execution_date.isoformat())
-        self.import_table(context, table_name, dst, self.columns, self.id_column, from_id, to_id)
+        self.import_table(context, table_name, dst, self.columns, self.id_column, from_id, to_id, self.derived_columns)
         context['db'].close()
 
 
@@ -152,6 +338,8 @@ class ImportRcData(HiveMappingMixin, ImportTableOperator):
         ('services', 'id', ['*']),
         ('acc_rec', 'acc_rec_id', ['*']),
         ('bills_fact', 'bill_ind', ['*']),
+        # TODO replace per-row pl/sql calls with derived columns when definitions of pack_contract.getNumber,
+        # pack_contract.getNameR and getaccountsum are known
         ('dogovor', 'ind', ['t.*', 'pack_contract.getNumber(t.ind) as sp_contract_name', 'pack_contract.getNameR(t.ind) as sp_full_name',
                             'pack_contract.getNumber(t.owner) as sp_owner', 'getaccountsum(t.ind) as sp_balance']),
         ('invoiceitems', 'invoice_id', ['*']),